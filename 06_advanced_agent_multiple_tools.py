@@ -14,7 +14,12 @@
 import os
 import re
 import csv
+import math
+import heapq
+import unicodedata
+import time
 import subprocess
+from collections import defaultdict
 from datetime import datetime
 import httpx
 from openai import OpenAI
@@ -32,6 +37,7 @@ class Agent:
     def __init__(self, system_prompt):
         self.system_prompt = system_prompt
         self.messages = [{"role": "system", "content": system_prompt}]
+        self.total_tokens = 0  # このエージェントが消費したトークン数の合計
     
     def __call__(self, message):
         """メッセージを送信して返答を取得"""
@@ -45,6 +51,10 @@ class Agent:
         result = completion.choices[0].message.content
         self.messages.append({"role": "assistant", "content": result})
         
+        # トークン使用量を記録（APIが返さない場合もある）
+        if completion.usage is not None:
+            self.total_tokens += completion.usage.total_tokens
+        
         return result
 
 
@@ -76,6 +86,10 @@ read_memos:
 例: read_memos: 
 保存されている全てのメモを読み込みます
 
+search_memos:
+例: search_memos: 会議
+キーワードに関連するメモを検索し、関連度の高い順に返します
+
 shell_command:
 例: shell_command: ls -la
 シェルコマンドを実行します
@@ -150,6 +164,94 @@ def weather(city):
         return f"天気情報取得エラー: {e}"
 
 
+class MemoIndex:
+    """
+    メモの全文検索用インデックス（転置インデックス）
+
+    日本語は単語の区切りがないため、文字2-gram（2文字ずつ区切ったもの）を
+    トークンとして使います。例: 「明日は会議」→「明日」「日は」「は会」「会議」
+    トークンごとに「そのトークンを含むメモの番号」を記録しておくことで、
+    全メモを走査せずに検索できます。
+    1文字での検索（「会」「雨」など）にも対応するため、1文字ずつのトークンも登録します。
+
+    ⚠️ インデックスはメモ本文ごとメモリ上に置き、起動後の最初の検索時にCSVから
+    作り直します。数十万件を超えると、この初回構築に数秒かかります。
+    """
+
+    # 1トークンあたりに調べるメモ数の上限（多くのメモに含まれるトークンは新しい順にここまで）
+    max_postings_per_token = 10000
+
+    def __init__(self):
+        self.memos = []                    # [(日時, メモ), ...]
+        self.postings = defaultdict(list)  # トークン -> [メモ番号, ...]
+
+    @staticmethod
+    def tokenize(text, unigrams=False):
+        """
+        テキストを文字2-gramの集合に分割
+
+        unigrams=Trueなら1文字ずつのトークンも加える（インデックス登録用）。
+        検索時は1文字の単語だけを1文字トークンとして扱う。
+        """
+        # 全角/半角や大文字/小文字の違いを吸収する
+        text = unicodedata.normalize("NFKC", text).lower()
+        tokens = set()
+        for word in text.split():
+            if unigrams or len(word) == 1:
+                tokens.update(word)
+            for i in range(len(word) - 1):
+                tokens.add(word[i:i + 2])
+        return tokens
+
+    def add(self, timestamp, memo):
+        """メモを1件インデックスに追加"""
+        memo_id = len(self.memos)
+        self.memos.append((timestamp, memo))
+        for token in self.tokenize(memo, unigrams=True):
+            self.postings[token].append(memo_id)
+
+    def search(self, query, top_k=5):
+        """クエリに関連するメモを関連度の高い順に最大top_k件返す"""
+        total = len(self.memos)
+        scores = defaultdict(float)
+        for token in self.tokenize(query):
+            ids = self.postings.get(token)
+            if not ids:
+                continue
+            # 珍しいトークンほど重みを大きくする（IDF）
+            idf = math.log(1 + total / len(ids))
+            # 多くのメモに含まれるトークンは新しいメモから上限件数だけ調べ、
+            # メモが何百万件あっても1回の検索の処理量が一定に収まるようにする
+            for memo_id in ids[-self.max_postings_per_token:]:
+                scores[memo_id] += idf
+        # スコアが同じなら新しいメモを優先
+        best = heapq.nlargest(top_k, scores.items(), key=lambda item: (item[1], item[0]))
+        return [self.memos[memo_id] for memo_id, _ in best]
+
+
+# メモの検索インデックス（最初の検索時にCSVから構築し、以降は保存のたびに追加）
+memo_index = None
+
+
+def load_memo_index(filename="memos.csv"):
+    """CSVファイルからメモの検索インデックスを構築（初回のみ）"""
+    global memo_index
+    if memo_index is None:
+        # 読み込みの途中で失敗しても中途半端なインデックスが残らないよう、
+        # 構築が終わってからグローバル変数に代入する
+        index = MemoIndex()
+        if os.path.exists(filename):
+            with open(filename, "r", newline="", encoding="utf-8") as f:
+                reader = csv.reader(f)
+                next(reader, None)  # ヘッダーをスキップ
+                for row in reader:
+                    if len(row) != 2:
+                        continue  # 空行や壊れた行は読み飛ばす
+                    index.add(row[0], row[1])
+        memo_index = index
+    return memo_index
+
+
 def save_memo(memo):
     """メモをCSVファイルに保存"""
     try:
@@ -165,6 +267,10 @@ def save_memo(memo):
                 writer.writerow(["日時", "メモ"])
             writer.writerow([timestamp, memo])
         
+        # 検索インデックスが構築済みなら、新しいメモだけを追加する
+        if memo_index is not None:
+            memo_index.add(timestamp, memo)
+        
         return f"メモを保存しました: {memo}"
     except Exception as e:
         return f"メモ保存エラー: {e}"
@@ -197,6 +303,29 @@ def read_memos(dummy=""):
         return f"メモ読み込みエラー: {e}"
 
 
+def search_memos(query):
+    """キーワードに関連するメモを検索（関連度の高い順に最大5件）"""
+    try:
+        if not query.strip():
+            return "検索キーワードを指定してください"
+        
+        index = load_memo_index()
+        if not index.memos:
+            return "まだメモは保存されていません"
+        
+        hits = index.search(query, top_k=5)
+        if not hits:
+            return f"「{query}」に一致するメモは見つかりませんでした"
+        
+        result = f"「{query}」の検索結果（上位{len(hits)}件）:\n"
+        for timestamp, memo in hits:
+            result += f"- [{timestamp}] {memo}\n"
+        
+        return result.strip()
+    except Exception as e:
+        return f"メモ検索エラー: {e}"
+
+
 def shell_command(command):
     """
     シェルコマンドを実行（危険なコマンドに注意！）
@@ -235,28 +364,92 @@ def shell_command(command):
         return f"コマンド実行エラー: {e}"
 
 
+# 副作用がある、または実行するたびに結果が変わりうるツール
+# （これらの結果は再利用せず、実行したら再利用用のキャッシュも捨てる）
+side_effect_actions = {"save_memo", "shell_command"}
+
+# 終了理由の表示名
+stop_reasons = {
+    "answer": "最終回答",
+    "loop": "ループ検出",
+    "max_tokens": "トークン数の上限",
+    "max_seconds": "時間の上限",
+    "max_turns": "最大ターン数",
+    "unknown_action": "不明なアクション",
+}
+
+
 # 利用可能なツール
 known_actions = {
     "weather": weather,
     "save_memo": save_memo,
     "read_memos": read_memos,
+    "search_memos": search_memos,
     "shell_command": shell_command,
 }
 
 
-def query(question, max_turns=5):
-    """ReActパターンでクエリを実行"""
+def print_stats(stats, max_turns):
+    """クエリの実行統計を表示"""
+    turns = stats["turns"]
+    # 節約とみなすのはループ検出で早めに止めた場合だけ（予算切れは節約ではない）
+    saved_turns = max_turns - turns if stats["stop_reason"] == "loop" else 0
+    # 節約できたトークン数は「1ターンあたりの平均トークン数 × 節約ターン数」で見積もる
+    saved_tokens = stats["tokens"] // turns * saved_turns if turns else 0
+    
+    print("\n📊 実行統計")
+    print(f"   終了理由: {stop_reasons[stats['stop_reason']]}")
+    print(f"   ターン数: {turns}/{max_turns}（節約: {saved_turns}ターン）")
+    print(f"   トークン数: {stats['tokens']}（節約見込み: 約{saved_tokens}トークン）")
+    print(f"   ツール実行: {stats['tool_calls']}回（再利用: {stats['reused_calls']}回）")
+    print(f"   経過時間: {stats['elapsed']:.1f}秒")
+
+
+def query(question, max_turns=5, max_tokens=None, max_seconds=None, max_repeats=2):
+    """
+    ReActパターンでクエリを実行
+    
+    - max_tokens / max_seconds: ターン数に加えて、トークン数と時間でも上限を設定できます
+    - max_repeats: 同じAction（同じ入力）や同じObservationが連続でこの回数
+      繰り返されたらループとみなして終了します
+    - 同じクエリ内で同じツールを同じ入力で呼んだ場合は、再実行せずに前回の結果を使います
+      （save_memoやshell_commandは毎回実行し、実行後はそれまでの結果を再利用しません）
+    """
     agent = Agent(REACT_PROMPT)
     next_prompt = question
     
+    tool_cache = {}         # (ツール名, 入力) -> 結果
+    last_key = None
+    last_observation = None
+    repeats = 0             # 繰り返しが連続した回数
+    start_time = time.monotonic()
+    stats = {"turns": 0, "tokens": 0, "tool_calls": 0, "reused_calls": 0,
+             "elapsed": 0.0, "stop_reason": None}
+    
+    def finish(answer, stop_reason):
+        stats["tokens"] = agent.total_tokens
+        stats["elapsed"] = time.monotonic() - start_time
+        stats["stop_reason"] = stop_reason
+        print_stats(stats, max_turns)
+        return answer
+    
     print(f"❓ 質問: {question}\n")
     print("=" * 60)
     
     for turn in range(1, max_turns + 1):
+        # トークン数・時間の予算をチェック
+        if max_tokens is not None and agent.total_tokens >= max_tokens:
+            print(f"\n⚠️ トークン数の上限（{max_tokens}）に達しました")
+            return finish(None, "max_tokens")
+        if max_seconds is not None and time.monotonic() - start_time >= max_seconds:
+            print(f"\n⚠️ 時間の上限（{max_seconds}秒）に達しました")
+            return finish(None, "max_seconds")
+        
         print(f"\n🔄 ターン {turn}")
         print("-" * 60)
         
         result = agent(next_prompt)
+        stats["turns"] = turn
         
         # 結果を見やすく表示
         print(f"🤔 AIの応答:\n{result}")
@@ -270,22 +463,47 @@ def query(question, max_turns=5):
             
             if action not in known_actions:
                 print(f"\n❌ エラー: 不明なアクション '{action}'")
-                return None
+                return finish(None, "unknown_action")
             
             print(f"\n⚙️  ツール実行: {action}")
             print(f"   入力: {action_input}")
-            observation = known_actions[action](action_input)
+            
+            key = (action, action_input.strip())
+            if key in tool_cache:
+                # 同じツールを同じ入力で呼んだ場合は前回の結果を再利用
+                observation = tool_cache[key]
+                stats["reused_calls"] += 1
+                repeated = True
+                print("   ♻️  同じ入力で実行済みのため、前回の結果を再利用します")
+            else:
+                observation = known_actions[action](action_input)
+                stats["tool_calls"] += 1
+                if action in side_effect_actions:
+                    # メモやファイルが変わったかもしれないので、これまでの結果は使わない
+                    tool_cache.clear()
+                else:
+                    tool_cache[key] = observation
+                repeated = key == last_key or observation == last_observation
             print(f"   結果: {observation}")
             
+            last_key = key
+            last_observation = observation
+            repeats = repeats + 1 if repeated else 0
+            if repeats >= max_repeats:
+                print("\n⚠️ 同じ行動の繰り返し（ループ）を検出したため終了します")
+                return finish(None, "loop")
+            
             next_prompt = f"Observation: {observation}"
+            if repeated:
+                next_prompt += "\n（この結果は前回と同じです。同じ行動を繰り返さず、得られた情報で回答してください）"
         else:
             # Actionがない場合は終了（最終回答）
             print("\n" + "=" * 60)
             print("✅ 最終回答が得られました")
-            return result
+            return finish(result, "answer")
     
     print("\n⚠️ 最大ターン数に達しました")
-    return None
+    return finish(None, "max_turns")
 
 
 if __name__ == "__main__":
@@ -296,10 +514,11 @@ if __name__ == "__main__":
     print("  🌤️  weather      - 天気情報を取得")
     print("  📝 save_memo     - メモをCSVファイルに保存")
     print("  📖 read_memos    - 保存したメモを読み込む")
+    print("  🔍 search_memos  - キーワードでメモを検索")
     print("  💻 shell_command - シェルコマンドを実行（⚠️ 危険なコマンドは禁止）")
     print("\n試してみよう:")
     print("  天気: 「東京の天気は？」")
-    print("  メモ: 「明日は会議があるとメモして」「今までのメモを見せて」")
+    print("  メモ: 「明日は会議があるとメモして」「今までのメモを見せて」「会議のメモを探して」")
     print("  コマンド: 「現在のディレクトリのファイル一覧を見せて」")
     print("=" * 60)
     